@@ -7,74 +7,209 @@ versions of files within a specified directory and time range.
 """
 
 import os
+import posixpath
+import re
 import json
+import math
 import argparse
+import errno
 import shutil
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from datetime import datetime, timedelta
-from pathlib import Path
-from urllib.parse import unquote
-from typing import Dict, List, Tuple, Optional
+from urllib.parse import unquote, unquote_to_bytes
+from typing import Dict, Iterable, List, Tuple, Optional
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers only
+# need to catch the stdlib error whichever parser is in use
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# copy_file_range errors meaning the filesystems can't do it, not a real failure
+_COPY_RANGE_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL}
+
+_SEP_TABLE = str.maketrans('\\', '/')
+
+# Path components made only of these characters appear verbatim in resource URLs
+_URL_SAFE = re.compile(r'[A-Za-z0-9._~-]+')
 
 def parse_timestamp(timestamp_ms: int) -> datetime:
     """Convert millisecond timestamp to datetime object."""
     return datetime.fromtimestamp(timestamp_ms / 1000)
 
+@lru_cache(maxsize=None)
 def url_decode_path(url_path: str) -> str:
     """Decode URL-encoded file path."""
     if url_path.startswith('file:///'):
         url_path = url_path[8:]  # Remove 'file:///'
-    return unquote(url_path)
+    
+    if '%' not in url_path:
+        return url_path
+    if not url_path.isascii():
+        # unquote passes non-ASCII runs through untouched, including lone
+        # surrogates from JSON "\ud800" escapes that can't be encoded
+        return unquote(url_path)
+    
+    # Decode the escapes as bytes in one pass, then the UTF-8 they spell out;
+    # this skips unquote's extra regex split into ASCII runs
+    return unquote_to_bytes(url_path).decode('utf-8', 'replace')
 
+@lru_cache(maxsize=None)
 def normalize_path(path: str) -> str:
-    """Normalize path separators and make it comparable."""
-    # Handle URL-encoded paths first
-    if path.startswith('file:///'):
-        path = url_decode_path(path)
-    
-    # Normalize separators and resolve path
-    normalized = os.path.normpath(path).replace('\\', '/')
+    """
+    Normalize path separators and make it comparable.
     
-    # Ensure consistent case on Windows (paths are case-insensitive)
+    Expects a plain path; resource URLs must go through url_decode_path first.
+    Path comparisons in this script assume both sides went through this
+    function; results are cached so repeated paths are only normalized once.
+    """
+    # Normalize separators in a single pass
+    normalized = path.translate(_SEP_TABLE)
+    
+    # Only pay for a full normpath when there are '.'/'..' segments or
+    # repeated slashes to resolve; typical absolute paths have neither
+    if not normalized or normalized[0] == '.' or '//' in normalized or '/.' in normalized:
+        normalized = posixpath.normpath(normalized)
+    elif len(normalized) > 1 and normalized[-1] == '/':
+        # Remove the trailing slash for consistency
+        normalized = normalized[:-1]
+    
+    # Ensure consistent case on Windows (paths are case-insensitive). This is
+    # lower() rather than casefold(): NTFS only folds case character by
+    # character, so e.g. "Straße" and "Strasse" are different files there
     if os.name == 'nt':
         normalized = normalized.lower()
     
-    # Remove trailing slashes for consistency
-    if normalized.endswith('/') and len(normalized) > 1:
-        normalized = normalized.rstrip('/')
-    
     return normalized
 
-def is_path_in_directory(file_path: str, target_dir: str) -> bool:
-    """Check if the file path is within the target directory."""
-    file_path_norm = normalize_path(file_path)
+def directory_prefix(target_dir: str) -> str:
+    """Normalize a directory path into a prefix for matching files inside it."""
+    # The restore path may be given as a file URL like the resources themselves
+    if target_dir.startswith('file:///'):
+        target_dir = url_decode_path(target_dir)
     target_dir_norm = normalize_path(target_dir)
     
     # Ensure target directory ends with / for proper prefix matching
     if not target_dir_norm.endswith('/'):
         target_dir_norm += '/'
     
-    return file_path_norm.startswith(target_dir_norm) or file_path_norm == target_dir_norm.rstrip('/')
+    return target_dir_norm
 
-def get_relative_path(file_path: str, target_dir: str) -> str:
-    """Get the relative path of a file within the target directory."""
-    file_path_norm = normalize_path(file_path)
-    target_dir_norm = normalize_path(target_dir)
+def _resource_marker(target_dir: str) -> Optional[bytes]:
+    """
+    Pick a piece of the target directory that any matching resource URL must
+    contain verbatim, so unrelated entries.json files can be rejected with a
+    substring test before parsing. Returns None if no component is safe to use.
+    """
+    # Work from the path as the user wrote it: case folding could turn a
+    # non-ASCII component into an ASCII one the URL never contains
+    if target_dir.startswith('file:///'):
+        target_dir = url_decode_path(target_dir)
+    
+    # Only characters that file URLs never percent-encode or JSON-escape
+    components = [part for part in target_dir.translate(_SEP_TABLE).split('/')
+                  if _URL_SAFE.fullmatch(part) and part.strip('.')]
+    if not components:
+        return None
+    
+    marker = max(components, key=len).encode('ascii')
+    return marker.lower() if os.name == 'nt' else marker
+
+def _relative_if_inside(file_path_norm: str, target_prefix: str) -> Optional[str]:
+    """Return the path relative to the directory prefix, or None if it lies outside."""
+    if not file_path_norm.startswith(target_prefix):
+        return None
+    return file_path_norm[len(target_prefix):]
+
+def find_latest_entry(entries: Iterable[dict], start_ms: int,
+                      end_ms: int) -> Tuple[Optional[dict], Optional[int]]:
+    """Return the newest entry (and its millisecond timestamp) within the time range."""
+    latest_entry = None
+    latest_ms = 0
+    
+    for entry in entries:
+        timestamp_ms = entry.get('timestamp')
+        if not timestamp_ms:
+            continue
+            
+        # Compare raw timestamps; only the winner is converted to a datetime
+        if timestamp_ms < start_ms or timestamp_ms > end_ms:
+            continue
+            
+        if timestamp_ms > latest_ms:
+            latest_entry = entry
+            latest_ms = timestamp_ms
     
-    # Ensure target directory ends with / for proper prefix matching
-    if not target_dir_norm.endswith('/'):
-        target_dir_norm += '/'
+    if latest_entry is None:
+        return None, None
+    return latest_entry, latest_ms
+
+def _process_folder(folder_path: str, target_prefix: str, marker: Optional[bytes],
+                    start_timestamp: float, start_ms: int, end_ms: int) -> Optional[Tuple[str, str, int]]:
+    """
+    Find the latest matching backup in a single history folder.
+    
+    Returns:
+        (relative_path, backup_file_path, timestamp_ms), or None if the folder
+        has nothing to restore
+    """
+    entries_file = os.path.join(folder_path, 'entries.json')
+    
+    try:
+        entries_stat = os.stat(entries_file)
+    except FileNotFoundError:
+        return None
+    
+    # entries.json is rewritten whenever an entry is added, so a file last
+    # modified before the range starts cannot hold a matching entry
+    if entries_stat.st_mtime < start_timestamp:
+        return None
+    
+    # Read the raw bytes in one call; both JSON backends accept bytes, so
+    # there's no need for open()'s buffering and text decoding layers
+    fd = os.open(entries_file, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        raw = os.read(fd, entries_stat.st_size)
+    finally:
+        os.close(fd)
+    
+    # Most folders belong to other projects; reject them before parsing
+    if marker is not None:
+        haystack = raw.lower() if os.name == 'nt' else raw
+        if marker not in haystack:
+            return None
+    
+    data = _loads(raw)
+    resource_url = data.get('resource', '')
+    
+    if not resource_url:
+        return None
+    
+    # Decode the file path
+    original_file_path = url_decode_path(resource_url)
+    file_path_norm = normalize_path(original_file_path)
+    
+    # Get the relative path, skipping files outside our target directory
+    relative_path = _relative_if_inside(file_path_norm, target_prefix)
+    if relative_path is None:
+        return None
+    
+    # Find the latest entry within our time range
+    latest_entry, latest_ms = find_latest_entry(data.get('entries', []), start_ms, end_ms)
     
-    if not (file_path_norm.startswith(target_dir_norm) or file_path_norm == target_dir_norm.rstrip('/')):
-        raise ValueError(f"File {file_path} is not within directory {target_dir}")
+    if not latest_entry:
+        return None
     
-    # Remove the target directory prefix
-    if file_path_norm == target_dir_norm.rstrip('/'):
-        # This is the root directory itself
-        return ""
+    backup_file_path = os.path.join(folder_path, latest_entry['id'])
+    if not os.path.isfile(backup_file_path):
+        return None
     
-    relative = file_path_norm[len(target_dir_norm):]
-    return relative
+    return relative_path, backup_file_path, latest_ms
 
 def find_latest_files(history_dir: str, target_restore_dir: str, 
                      start_time: datetime, end_time: datetime) -> Dict[str, Tuple[str, datetime]]:
@@ -84,108 +219,166 @@ def find_latest_files(history_dir: str, target_restore_dir: str,
     Returns:
         Dict mapping relative file paths to (backup_file_path, timestamp) tuples
     """
-    latest_files = {}
-    
-    history_path = Path(history_dir)
-    if not history_path.exists():
+    if not os.path.exists(history_dir):
         raise FileNotFoundError(f"History directory not found: {history_dir}")
     
     print(f"Scanning history directory: {history_dir}")
     print(f"Looking for files from: {target_restore_dir}")
     print(f"Time range: {start_time} to {end_time}")
     
+    target_prefix = directory_prefix(target_restore_dir)
+    marker = _resource_marker(target_restore_dir)
+    start_timestamp = start_time.timestamp()
+    # Whole milliseconds that fall inside [start_time, end_time]
+    start_ms = math.ceil(start_timestamp * 1000)
+    end_ms = math.floor(end_time.timestamp() * 1000)
     folder_count = 0
-    matching_files = 0
+    found = []
     
-    # Iterate through all folders in the history directory
-    for folder in history_path.iterdir():
-        if not folder.is_dir():
-            continue
-            
-        folder_count += 1
-        entries_file = folder / "entries.json"
+    # Folders are independent, so scan them concurrently; the reads and
+    # parsing overlap while results are merged here on a single thread
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
         
-        if not entries_file.exists():
-            continue
-            
-        try:
-            with open(entries_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            resource_url = data.get('resource', '')
-            if not resource_url:
-                continue
-                
-            # Decode the file path
-            original_file_path = url_decode_path(resource_url)
-            
-
-            # Check if this file is within our target directory
-            if not is_path_in_directory(original_file_path, target_restore_dir):
-                continue
+        # Iterate through all folders in the history directory
+        with os.scandir(history_dir) as it:
+            for folder in it:
+                # DirEntry caches the file type, so this costs no extra syscall
+                if not folder.is_dir(follow_symlinks=False):
+                    continue
                 
-            # Get relative path within the target directory
+                folder_count += 1
+                future = executor.submit(_process_folder, folder.path, target_prefix, marker,
+                                         start_timestamp, start_ms, end_ms)
+                futures[future] = folder.path
+        
+        for future in as_completed(futures):
             try:
-                relative_path = get_relative_path(original_file_path, target_restore_dir)
-            except ValueError:
+                result = future.result()
+            except (json.JSONDecodeError, KeyError, OSError) as e:
+                print(f"Warning: Error processing {futures[future]}: {e}")
                 continue
             
-            # Find the latest entry within our time range
-            latest_entry = None
-            latest_timestamp = None
-            
-            for entry in data.get('entries', []):
-                timestamp_ms = entry.get('timestamp')
-                if not timestamp_ms:
-                    continue
-                    
-                entry_time = parse_timestamp(timestamp_ms)
-                
-                # Check if within time range
-                if not (start_time <= entry_time <= end_time):
-                    continue
-                    
-                if latest_timestamp is None or entry_time > latest_timestamp:
-                    latest_entry = entry
-                    latest_timestamp = entry_time
+            if result is None:
+                continue
             
-            if latest_entry:
-                backup_file_path = folder / latest_entry['id']
-                if backup_file_path.exists():
-                    latest_files[relative_path] = (str(backup_file_path), latest_timestamp)
-                    matching_files += 1
-                    print(f"Found: {relative_path} (from {latest_timestamp})")
-        
-        except (json.JSONDecodeError, KeyError, OSError) as e:
-            print(f"Warning: Error processing {folder}: {e}")
-            continue
+            found.append(result)
+    
+    # Folders complete in any order; sorting by path then timestamp puts the
+    # newest backup of each file last, so it wins when the dict is built
+    found.sort(key=lambda result: (result[0], result[2]))
+    
+    pairs = []
+    found_lines = []
+    for relative_path, backup_file_path, latest_ms in found:
+        latest_timestamp = parse_timestamp(latest_ms)
+        pairs.append((relative_path, (backup_file_path, latest_timestamp)))
+        found_lines.append(f"Found: {relative_path} (from {latest_timestamp})")
     
-    print(f"\nProcessed {folder_count} folders, found {matching_files} matching files")
+    # Build the result in one go instead of growing it an insert at a time
+    latest_files = dict(pairs)
+    
+    # Report matches in one write rather than one locked print per file
+    if found_lines:
+        sys.stdout.write('\n'.join(found_lines) + '\n')
+    
+    print(f"\nProcessed {folder_count} folders, found {len(found)} matching files")
     return latest_files
 
+def _copy_with_file_range(src_fd: int, dst_fd: int, size: int) -> bool:
+    """Copy size bytes between fds inside the kernel; returns False if the filesystems can't."""
+    remaining = size
+    while remaining > 0:
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, remaining)
+        except OSError as e:
+            # Nothing written yet, so the caller can still fall back
+            if remaining == size and e.errno in _COPY_RANGE_UNSUPPORTED:
+                return False
+            raise
+        if not copied:
+            # Some filesystems report "can't" as a zero-length copy
+            if remaining == size:
+                return False
+            raise OSError(errno.EIO, f"copy_file_range stopped with {remaining} bytes left")
+        remaining -= copied
+    return True
+
+def copy_file(src: str, dst: str):
+    """Copy a backup file to dst, preserving its access and modification times."""
+    if hasattr(os, 'copy_file_range'):
+        # One fstat serves both the copy size and the timestamps, and the
+        # times are set through the open fd: open, fstat, open, copy,
+        # futimens, close, close is the whole per-file syscall budget
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            st = os.fstat(src_fd)
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                if _copy_with_file_range(src_fd, dst_fd, st.st_size):
+                    os.utime(dst_fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+                    return
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+    
+    shutil.copyfile(src, dst)
+    st = os.stat(src)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
 def restore_files(latest_files: Dict[str, Tuple[str, datetime]], output_dir: str):
     """Restore the files to the output directory."""
-    output_path = Path(output_dir)
-    output_path.mkdir(parents=True, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
     
     print(f"\nRestoring files to: {output_dir}")
     
+    # Create the full output paths (plain strings; os.path.join is cheaper
+    # than building Path objects for every file)
+    output_file_paths = {relative_path: os.path.join(output_dir, relative_path)
+                         for relative_path in latest_files}
+    
+    # Create each parent directory once up front rather than once per file,
+    # which also keeps the copy workers from racing on mkdir
+    unique_dirs = set()
+    for relative_path in latest_files:
+        relative_dir = os.path.dirname(relative_path)
+        if relative_dir:
+            unique_dirs.add(os.path.join(output_dir, relative_dir))
+    
+    # Shallowest first, so each mkdir finds its parent already in place
+    # instead of failing and walking up the tree
+    for directory in sorted(unique_dirs, key=len):
+        try:
+            os.mkdir(directory)
+        except FileExistsError:
+            pass
+        except FileNotFoundError:
+            # An intermediate directory that holds no files directly
+            os.makedirs(directory, exist_ok=True)
+    
     restored_count = 0
+    restored_lines = []
     
-    for relative_path, (backup_file_path, timestamp) in latest_files.items():
-        # Create the full output path
-        output_file_path = output_path / relative_path
-        
-        # Create parent directories if needed
-        output_file_path.parent.mkdir(parents=True, exist_ok=True)
+    # Overlap the copies; with many small files the cost is mostly syscalls
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [(relative_path,
+                    executor.submit(copy_file, backup_file_path, output_file_paths[relative_path]))
+                   for relative_path, (backup_file_path, timestamp) in latest_files.items()]
         
-        try:
-            # Copy the file
-            shutil.copy2(backup_file_path, output_file_path)
-            print(f"Restored: {relative_path}")
-            restored_count += 1
-        except OSError as e:
-            print(f"Error restoring {relative_path}: {e}")
+        for relative_path, future in futures:
+            e = future.exception()
+            if e is None:
+                restored_lines.append(f"Restored: {relative_path}")
+                restored_count += 1
+            elif isinstance(e, OSError):
+                print(f"Error restoring {relative_path}: {e}")
+            else:
+                raise e
+    
+    if restored_lines:
+        sys.stdout.write('\n'.join(restored_lines) + '\n')
     
     print(f"\nSuccessfully restored {restored_count} files")
 
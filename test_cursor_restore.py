@@ -0,0 +1,75 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import cursor_restore
+
+
+def clear_path_caches():
+    cursor_restore.normalize_path.cache_clear()
+    cursor_restore.url_decode_path.cache_clear()
+
+
+class HistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        clear_path_caches()
+        self.addCleanup(clear_path_caches)
+
+    def make_history(self, *resources: str) -> str:
+        history_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, history_dir)
+        for index, resource in enumerate(resources):
+            folder = os.path.join(history_dir, f'folder{index}')
+            os.mkdir(folder)
+            with open(os.path.join(folder, 'AbCd.py'), 'w') as f:
+                f.write('print("restored")\n')
+            with open(os.path.join(folder, 'entries.json'), 'w') as f:
+                json.dump({'version': 1, 'resource': resource,
+                           'entries': [{'id': 'AbCd.py', 'timestamp': int(time.time() * 1000)}]}, f)
+        return history_dir
+
+    def find(self, history_dir: str, restore_path: str):
+        end_time = datetime.now() + timedelta(minutes=1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return cursor_restore.find_latest_files(
+                history_dir, restore_path, end_time - timedelta(days=1), end_time)
+
+
+class ResourceDecodingTest(HistoryTestCase):
+    def test_lone_surrogate_resource_does_not_abort_scan(self):
+        # The stdlib parser turns a JSON "\ud800" escape into a lone surrogate
+        history_dir = self.make_history('file:///c%3A/Users/Max/Proj/ok%20file.py',
+                                        'file:///c%3A/Users/Max/Other/\ud800%20bad.py')
+        with mock.patch.object(cursor_restore, '_loads', json.loads):
+            latest_files = self.find(history_dir, 'c:/Users/Max/Proj')
+        self.assertEqual(list(latest_files), ['ok file.py'])
+
+
+class WindowsPathsTest(HistoryTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(cursor_restore.os, 'name', 'nt')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_finds_files_under_sharp_s_directory(self):
+        history_dir = self.make_history('file:///c%3A/Users/Max/Gro%C3%9Fprojekt/main.py')
+        latest_files = self.find(history_dir, 'C:/Users/Max/Großprojekt')
+        self.assertEqual(list(latest_files), ['main.py'])
+
+    def test_finds_files_under_directory_that_lowercases_to_ascii(self):
+        # KELVIN SIGN lowercases to a plain "k", which the URL never contains
+        history_dir = self.make_history('file:///c%3A/Users/Max/%E2%84%AAelvin/main.py')
+        latest_files = self.find(history_dir, 'C:/Users/Max/\u212aelvin')
+        self.assertEqual(list(latest_files), ['main.py'])
+
+
+if __name__ == '__main__':
+    unittest.main()